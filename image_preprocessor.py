@@ -44,6 +44,29 @@ def pad_to_square(tensor):
 
     return padded_tensor.permute(1, 2, 0).unsqueeze(0)
 
+def clip_preprocess(image, processor):
+    # approximation of CLIPImageProcessor (resize shortest side -> center crop -> normalize) on the image's device,
+    # using the processor's config. torch bicubic (a=-0.75) differs slightly from PIL's (a=-0.5).
+    size = processor.size["shortest_edge"]
+    crop_h, crop_w = processor.crop_size["height"], processor.crop_size["width"]
+
+    image = image.permute(0, 3, 1, 2)
+    _, _, h, w = image.shape
+    # the long side is truncated like transformers does
+    if h < w:
+        new_h, new_w = size, int(size * w / h)
+    else:
+        new_h, new_w = int(size * h / w), size
+    image = F.interpolate(image, size=(new_h, new_w), mode="bicubic", antialias=True).clamp(0, 1)
+
+    top = (new_h - crop_h) // 2
+    left = (new_w - crop_w) // 2
+    image = image[:, :, top:top+crop_h, left:left+crop_w]
+
+    mean = torch.tensor(processor.image_mean, device=image.device, dtype=image.dtype).view(1, 3, 1, 1)
+    std = torch.tensor(processor.image_std, device=image.device, dtype=image.dtype).view(1, 3, 1, 1)
+    return (image - mean) / std
+
 def face_crop(image):
     image = image_to_numpy(image)
     face_cascade = cv2.CascadeClassifier(os.path.join(CURRENT_DIR, DETECTOR_FILE))
@@ -1,9 +1,8 @@
 import torch
 import torch.nn.functional as F
 import os
-from .image_preprocessor import pad_to_square, face_crop, CV2_AVAILABLE
+from .image_preprocessor import pad_to_square, face_crop, clip_preprocess, CV2_AVAILABLE
 from .resampler import Resampler
-from einops import rearrange
 import contextlib
 import comfy.model_management
 import inspect
@@ -15,38 +14,59 @@ CROP_MODES = ["padding", "face_crop", "none"] if CV2_AVAILABLE else ["padding",
 SD_V12_CHANNELS = [320] * 4 + [640] * 4 + [1280] * 4 + [1280] * 6 + [640] * 6 + [320] * 6 + [1280] * 2
 SD_XL_CHANNELS = [640] * 8 + [1280] * 40 + [1280] * 60 + [640] * 12 + [1280] * 20
 
+# attn2 patch keys in the same order (input -> output -> middle)
+SD_V12_BLOCK_KEYS = (
+    [("input", id) for id in [1, 2, 4, 5, 7, 8]] + # id of input_blocks that have cross attention
+    [("output", id) for id in [3, 4, 5, 6, 7, 8, 9, 10, 11]] + # id of output_blocks that have cross attention
+    [("middle", 0)]
+)
+SD_XL_BLOCK_KEYS = (
+    [("input", id, index) for id in [4, 5, 7, 8] for index in range(2 if id in [4, 5] else 10)] + # range(transformer_depth)
+    [("output", id, index) for id in range(6) for index in range(2 if id in [3, 4, 5] else 10)] +
+    [("middle", 0, index) for index in range(10)]
+)
+
 def get_file_list(path):
     return [file for file in os.listdir(path) if file != "put_models_here.txt"]
 
 def set_model_patch_replace(model, patch_kwargs, key):
-    to = model.model_options["transformer_options"]
-    if "patches_replace" not in to:
-        to["patches_replace"] = {}
-    if "attn2" not in to["patches_replace"]:
-        to["patches_replace"]["attn2"] = {}
-    if key not in to["patches_replace"]["attn2"]:
-        patch = CrossAttentionPatch(**patch_kwargs)
-        to["patches_replace"]["attn2"][key] = patch
+    attn2 = model.model_options["transformer_options"].setdefault("patches_replace", {}).setdefault("attn2", {})
+    if key not in attn2:
+        attn2[key] = CrossAttentionPatch(**patch_kwargs)
     else:
-        to["patches_replace"]["attn2"][key].set_new_condition(**patch_kwargs)
+        attn2[key].set_new_condition(**patch_kwargs)
 
 def attention(q, k, v, extra_options):
-    if not hasattr(F, "multi_head_attention_forward"):
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=extra_options["n_heads"]), (q, k, v))
-        sim = torch.einsum('b i d, b j d -> b i j', q, k) * (extra_options["dim_head"] ** -0.5)
-        sim = F.softmax(sim, dim=-1)
-        out = torch.einsum('b i j, b j d -> b i d', sim, v)
-        out = rearrange(out, '(b h) n d -> b n (h d)', h=extra_options["n_heads"])
-    else:
-        b, _, _ = q.shape
-        q, k, v = map(
-            lambda t: t.view(b, -1, extra_options["n_heads"], extra_options["dim_head"]).transpose(1, 2),
-            (q, k, v),
-        )
-        out = F.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=0.0, is_causal=False)
-        out = out.transpose(1, 2).reshape(b, -1, extra_options["n_heads"] * extra_options["dim_head"])
+    b, _, _ = q.shape
+    n_heads, dim_head = extra_options["n_heads"], extra_options["dim_head"]
+    # (b, n, h*d) -> (b, h, n, d); only the last dim has to be contiguous for the fused sdpa kernels.
+    q, k, v = map(
+        lambda t: t.view(b, -1, n_heads, dim_head).transpose(1, 2),
+        (q, k, v),
+    )
+    out = F.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=0.0, is_causal=False)
+    out = out.transpose(1, 2).reshape(b, -1, n_heads * dim_head)
     return out
 
+# ip_adapter branch of CrossAttentionPatch, tensors only so that it can be traced by torch.compile.
+# weight is already folded into ip_v (attention is linear in v), so no python float is baked into the graph.
+def _patch_forward(out, q, ip_k, ip_v, mask_downsample, n_heads, dim_head):
+    ip_out = attention(q, ip_k, ip_v, {"n_heads": n_heads, "dim_head": dim_head})
+    if mask_downsample is not None:
+        ip_out.mul_(mask_downsample)
+    # out isn't updated in place: cudagraphs of torch.compile are skipped for mutated inputs
+    return torch.add(out, ip_out)
+
+# dynamo caches compiled graphs on the code object of _patch_forward, so a single compiled function is shared by all
+# blocks. shapes are left to dynamo's automatic dynamic shapes instead of specializing every resolution.
+COMPILED_PATCH_FORWARD = None
+
+def get_patch_forward():
+    global COMPILED_PATCH_FORWARD
+    if COMPILED_PATCH_FORWARD is None:
+        COMPILED_PATCH_FORWARD = torch.compile(_patch_forward, mode="reduce-overhead", fullgraph=False)
+    return COMPILED_PATCH_FORWARD
+
 
 class ImageProjModel(torch.nn.Module):
     """Projection Model"""
@@ -70,12 +90,29 @@ class To_KV(torch.nn.Module):
         super().__init__()
 
         channels = SD_XL_CHANNELS if cross_attention_dim == 2048 else SD_V12_CHANNELS
-        self.to_kvs = torch.nn.ModuleList([torch.nn.Linear(cross_attention_dim, channel, bias=False) for channel in channels])
+        # to_k_ip, to_v_ip with the same channel are stored as one weight so that they are projected by one matmul
+        self.num_layers = len(channels)
+        self.channels = sorted(set(channels))
+        self.indices = [[i for i, c in enumerate(channels) if c == channel] for channel in self.channels]
+        self.weights = torch.nn.ParameterList([
+            torch.nn.Parameter(torch.empty(len(indices) * channel, cross_attention_dim), requires_grad=False)
+            for channel, indices in zip(self.channels, self.indices)
+        ])
         
     def load_state_dict(self, state_dict):
         # input -> output -> middle
-        for i, key in enumerate(state_dict.keys()):
-            self.to_kvs[i].weight.data = state_dict[key]
+        weights = list(state_dict.values())
+        for i, indices in enumerate(self.indices):
+            self.weights[i] = torch.nn.Parameter(torch.cat([weights[j] for j in indices], dim=0), requires_grad=False)
+
+    def forward(self, x):
+        # returns outputs of every layer in the original order.
+        # weights may stay on cpu, they are only needed once per load so each group is copied to x.device just for its matmul.
+        outs = [None] * self.num_layers
+        for channel, indices, weight in zip(self.channels, self.indices, self.weights):
+            for i, out in zip(indices, F.linear(x, weight.to(x.device)).split(channel, dim=-1)):
+                outs[i] = out
+        return outs
     
 class IPAdapterModel(torch.nn.Module):
     def __init__(self, state_dict, plus, cross_attention_dim=768, clip_embeddings_dim=1024, clip_extra_context_tokens=4, sdxl_plus=False):
@@ -99,7 +136,7 @@ class IPAdapterModel(torch.nn.Module):
                 clip_extra_context_tokens=clip_extra_context_tokens
             )
         
-        self.image_proj_model.load_state_dict(state_dict["image_proj"])
+        self.image_proj_model.load_state_dict(state_dict["image_proj"], assign=True)
         self.ip_layers = To_KV(cross_attention_dim)
         self.ip_layers.load_state_dict(state_dict["ip_adapter"])
         
@@ -108,6 +145,13 @@ class IPAdapterModel(torch.nn.Module):
         image_prompt_embeds = self.image_proj_model(cond)
         uncond_image_prompt_embeds = self.image_proj_model(uncond)
         return image_prompt_embeds, uncond_image_prompt_embeds
+
+    @torch.inference_mode()
+    def get_kvs(self, image_prompt_embeds, uncond_image_prompt_embeds):
+        # k, v of every cross attention (to_k_ip, to_v_ip alternately), cond and uncond in one batch
+        kvs = self.ip_layers(torch.cat([image_prompt_embeds, uncond_image_prompt_embeds], dim=0))
+        cond_kvs, uncond_kvs = zip(*[kv.chunk(2, dim=0) for kv in kvs])
+        return list(cond_kvs), list(uncond_kvs)
     
 
 class IPAdapter:
@@ -125,7 +169,10 @@ class IPAdapter:
                     "step": 0.05 #Slider's step
                 }),
                 "model_name": (get_file_list(os.path.join(CURRENT_DIR,"models")), ),
-                "dtype": (["fp16", "fp32"], ),
+                "dtype": (["bf16", "fp16", "fp32"], ),
+                "fuse_ip_attention": (["disable", "enable"], ),
+                "torch_compile": (["disable", "enable"], ),
+                "tf32_cudnn_benchmark": (["disable", "enable"], ),
             },
             "optional": {
                 "mask": ("MASK",),
@@ -136,12 +183,26 @@ class IPAdapter:
     FUNCTION = "adapter"
     CATEGORY = "loaders"
 
-    def adapter(self, model, image, clip_vision, weight, model_name, dtype, mask=None):
+    def adapter(self, model, image, clip_vision, weight, model_name, dtype, fuse_ip_attention="disable", torch_compile="disable", tf32_cudnn_benchmark="disable", mask=None):
         device = comfy.model_management.get_torch_device()
-        self.dtype = torch.float32 if dtype == "fp32" or device.type == "mps" else torch.float16
+        ampere = device.type == "cuda" and torch.cuda.get_device_capability(device)[0] >= 8
+        if ampere and tf32_cudnn_benchmark == "enable":
+            # process-wide, so only when the user asks for it
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.benchmark = True
+        if dtype == "fp32" or device.type == "mps":
+            self.dtype = torch.float32
+        elif dtype == "bf16" and ampere:
+            self.dtype = torch.bfloat16
+        else:
+            self.dtype = torch.float16
         self.weight = weight # ip_adapter scale
 
         ip_state_dict = torch.load(os.path.join(CURRENT_DIR, os.path.join(CURRENT_DIR, "models", model_name)), map_location="cpu")
+        # cast before building the model so that fp32 weights are never copied to the device
+        for state_dict in ip_state_dict.values():
+            for key in state_dict:
+                state_dict[key] = state_dict[key].to(self.dtype)
         self.plus = "latents" in ip_state_dict["image_proj"]
 
         # cross_attention_dim is equal to text_encoder output
@@ -156,23 +217,45 @@ class IPAdapter:
         else:
             self.clip_extra_context_tokens = ip_state_dict["image_proj"]["proj.weight"].shape[0] // self.cross_attention_dim            
 
-        cond, uncond, outputs = self.clip_vision_encode(clip_vision, image, self.plus)
-        self.clip_embeddings_dim = cond.shape[-1]
+        # input dim of image_proj, equal to the clip vision output
+        if self.plus:
+            self.clip_embeddings_dim = ip_state_dict["image_proj"]["proj_in.weight"].shape[1]
+        else:
+            self.clip_embeddings_dim = ip_state_dict["image_proj"]["proj.weight"].shape[1]
         
-        self.ipadapter = IPAdapterModel(
-            ip_state_dict,
-            plus = self.plus,
-            cross_attention_dim = self.cross_attention_dim,
-            clip_embeddings_dim = self.clip_embeddings_dim,
-            clip_extra_context_tokens = self.clip_extra_context_tokens,
-            sdxl_plus = self.sdxl_plus
-        )
+        # parameters are created on meta and replaced by the loaded weights, so nothing is initialized in vain
+        with torch.device("meta"):
+            self.ipadapter = IPAdapterModel(
+                ip_state_dict,
+                plus = self.plus,
+                cross_attention_dim = self.cross_attention_dim,
+                clip_embeddings_dim = self.clip_embeddings_dim,
+                clip_extra_context_tokens = self.clip_extra_context_tokens,
+                sdxl_plus = self.sdxl_plus
+            )
 
-        self.ipadapter.to(device, dtype=self.dtype)
+        # ip_layers are only used to project k, v once (see get_kvs), so they are not kept on the device.
+        if device.type == "cuda":
+            # upload image_proj from pinned memory on another stream while clip vision is running
+            for param in self.ipadapter.image_proj_model.parameters():
+                param.data = param.data.pin_memory()
+            upload_stream = torch.cuda.Stream(device)
+            with torch.cuda.stream(upload_stream):
+                self.ipadapter.image_proj_model.to(device, dtype=self.dtype, non_blocking=True)
+            cond, uncond, outputs = self.clip_vision_encode(clip_vision, image, self.plus)
+            torch.cuda.current_stream(device).wait_stream(upload_stream)
+            # parameters were allocated on upload_stream but are used (and freed) on the default stream
+            for param in self.ipadapter.image_proj_model.parameters():
+                param.record_stream(torch.cuda.current_stream(device))
+        else:
+            self.ipadapter.image_proj_model.to(device, dtype=self.dtype)
+            cond, uncond, outputs = self.clip_vision_encode(clip_vision, image, self.plus)
 
         self.image_emb, self.uncond_image_emb = self.ipadapter.get_image_embeds(cond.to(device, dtype=self.dtype), uncond.to(device, dtype=self.dtype))
         self.image_emb = self.image_emb.to(device, dtype=self.dtype)
         self.uncond_image_emb = self.uncond_image_emb.to(device, dtype=self.dtype)
+        # k, v of ip_adapter don't change during sampling, so project them only once.
+        self.cond_kvs, self.uncond_kvs = self.ipadapter.get_kvs(self.image_emb, self.uncond_image_emb)
         # Not sure of batch size at this point.
         self.cond_uncond_image_emb = None
         
@@ -188,59 +271,42 @@ class IPAdapter:
         patch_name of sdxl: ("input" or "output" or "middle", block_id, transformer_index)
         '''
         patch_kwargs = {
-            "number": 0,
             "weight": self.weight,
-            "ipadapter": self.ipadapter,
             "dtype": self.dtype,
-            "cond": self.image_emb,
-            "uncond": self.uncond_image_emb,
-            "mask": mask
+            "cond_kvs": self.cond_kvs,
+            "uncond_kvs": self.uncond_kvs,
+            "mask": mask,
+            "fuse": fuse_ip_attention == "enable",
+            # conditions which never contribute (weight 0 or empty mask) are skipped, checked once for all blocks
+            "active": self.weight != 0 and (mask is None or bool(mask.any())),
+            "torch_compile": torch_compile == "enable",
         }
 
-        if not self.sdxl:
-            for id in [1,2,4,5,7,8]: # id of input_blocks that have cross attention
-                set_model_patch_replace(new_model, patch_kwargs, ("input", id))
-                patch_kwargs["number"] += 1
-            for id in [3,4,5,6,7,8,9,10,11]: # id of output_blocks that have cross attention
-                set_model_patch_replace(new_model, patch_kwargs, ("output", id))
-                patch_kwargs["number"] += 1
-            set_model_patch_replace(new_model, patch_kwargs, ("middle", 0))
-        else:
-            for id in [4,5,7,8]: # id of input_blocks that have cross attention
-                block_indices = range(2) if id in [4, 5] else range(10) # transformer_depth
-                for index in block_indices:
-                    set_model_patch_replace(new_model, patch_kwargs, ("input", id, index))
-                    patch_kwargs["number"] += 1
-            for id in range(6): # id of output_blocks that have cross attention
-                block_indices = range(2) if id in [3, 4, 5] else range(10) # transformer_depth
-                for index in block_indices:
-                    set_model_patch_replace(new_model, patch_kwargs, ("output", id, index))
-                    patch_kwargs["number"] += 1
-            for index in range(10):
-                set_model_patch_replace(new_model, patch_kwargs, ("middle", 0, index))
-                patch_kwargs["number"] += 1
+        block_keys = SD_XL_BLOCK_KEYS if self.sdxl else SD_V12_BLOCK_KEYS
+        for number, key in enumerate(block_keys):
+            set_model_patch_replace(new_model, {**patch_kwargs, "number": number}, key)
 
         return (new_model, outputs)
     
     def clip_vision_encode(self, clip_vision, image, plus=False):
-        img = torch.clip((255. * image), 0, 255).round().int()
-        img = list(map(lambda a: a, img))
-        inputs = clip_vision.processor(images=img, return_tensors="pt")
         comfy.model_management.load_model_gpu(clip_vision.patcher)
-        pixel_values = inputs['pixel_values'].to(clip_vision.load_device)
+        pixel_values = clip_preprocess(image.to(clip_vision.load_device), clip_vision.processor)
 
         if clip_vision.dtype != torch.float32:
             precision_scope = torch.autocast
         else:
             precision_scope = lambda a, b: contextlib.nullcontext(a)
 
+        batch_size = pixel_values.shape[0]
+        if plus:
+            # uncond of plus is the hidden state of a zero image, encode it in the same batch
+            pixel_values = torch.cat([pixel_values, torch.zeros_like(pixel_values)], dim=0)
+
         with precision_scope(comfy.model_management.get_autocast_device(clip_vision.load_device), torch.float32):
             outputs = clip_vision.model(pixel_values=pixel_values, output_hidden_states=True)
 
         if plus:
-            cond = outputs.hidden_states[-2]
-            with precision_scope(comfy.model_management.get_autocast_device(clip_vision.load_device), torch.float32):
-                uncond = clip_vision.model(torch.zeros_like(pixel_values), output_hidden_states=True).hidden_states[-2]
+            cond, uncond = outputs.hidden_states[-2].chunk(2, dim=0)
         else:
             cond = outputs.image_embeds
             uncond = torch.zeros_like(cond)
@@ -249,59 +315,104 @@ class IPAdapter:
             if k == "hidden_states":
                 outputs[k] = None
             elif t is not None:
-                outputs[k] = t.cpu()
+                outputs[k] = t[:batch_size].cpu()
         return cond, uncond, outputs
 
 
 class CrossAttentionPatch:
     # forward for patching
-    def __init__(self, weight, ipadapter, dtype, number, cond, uncond, mask=None):
+    def __init__(self, weight, dtype, number, cond_kvs, uncond_kvs, mask=None, fuse=False, active=True, torch_compile=False):
         self.weights = [weight]
-        self.ipadapters = [ipadapter]
-        self.conds = [cond]
-        self.unconds = [uncond]
         self.dtype = dtype
         self.number = number
+        # k, v of this block stacked as (cond, uncond) so that they can be gathered by cond_or_uncond
+        self.ip_ks = [torch.stack([cond_kvs[number*2], uncond_kvs[number*2]])]
+        self.ip_vs = [torch.stack([cond_kvs[number*2+1], uncond_kvs[number*2+1]])]
+        self.ip_kv_cache = {} # (cond_or_uncond, batch_prompt) -> [(ip_k, ip_v) of each condition]
         self.masks = [mask]
+        self.mask_caches = [{}] # out.shape[1] -> downsampled mask
+        self.fuses = [fuse]
+        self.actives = [active]
+        self.torch_compiles = [torch_compile]
     
-    def set_new_condition(self, weight, ipadapter, cond, uncond, dtype, number, mask=None):
+    def set_new_condition(self, weight, dtype, number, cond_kvs, uncond_kvs, mask=None, fuse=False, active=True, torch_compile=False):
         self.weights.append(weight)
-        self.ipadapters.append(ipadapter)
-        self.conds.append(cond)
-        self.unconds.append(uncond)
+        self.ip_ks.append(torch.stack([cond_kvs[self.number*2], uncond_kvs[self.number*2]]))
+        self.ip_vs.append(torch.stack([cond_kvs[self.number*2+1], uncond_kvs[self.number*2+1]]))
+        self.ip_kv_cache.clear()
         self.masks.append(mask)
+        self.mask_caches.append({})
+        self.fuses.append(fuse)
+        self.actives.append(active)
+        self.torch_compiles.append(torch_compile)
         self.dtype = dtype
 
     def __call__(self, n, context_attn2, value_attn2, extra_options):
         org_dtype = n.dtype
-        frame = inspect.currentframe()
-        outer_frame = frame.f_back
-        cond_or_uncond = outer_frame.f_locals["transformer_options"]["cond_or_uncond"]
+        if "cond_or_uncond" in extra_options:
+            cond_or_uncond = extra_options["cond_or_uncond"]
+        else:
+            # older ComfyUI doesn't pass cond_or_uncond to attn2 patches
+            cond_or_uncond = inspect.currentframe().f_back.f_locals["transformer_options"]["cond_or_uncond"]
         with torch.autocast("cuda", dtype=self.dtype):
             q = n
-            k = context_attn2
-            v = value_attn2
+            k = [context_attn2]
+            v = [value_attn2]
             b, _, _ = q.shape
             batch_prompt = b // len(cond_or_uncond)
-            out = attention(q, k, v, extra_options)
-
-            for weight, cond, uncond, ipadapter, mask in zip(self.weights, self.conds, self.unconds, self.ipadapters, self.masks):
-                uncond_cond = torch.cat([(cond.repeat(batch_prompt, 1, 1), uncond.repeat(batch_prompt, 1, 1))[i] for i in cond_or_uncond], dim=0)
-
-                # k, v for ip_adapter
-                ip_k = ipadapter.ip_layers.to_kvs[self.number*2](uncond_cond)
-                ip_v = ipadapter.ip_layers.to_kvs[self.number*2+1](uncond_cond)
-
-                ip_out = attention(q, ip_k, ip_v, extra_options)
-                
+            n_heads, dim_head = extra_options["n_heads"], extra_options["dim_head"]
+            ip_branches = []
+
+            # k, v for ip_adapter only depend on cond_or_uncond and batch_prompt, which rarely change between steps
+            key = (tuple(cond_or_uncond), batch_prompt)
+            if key not in self.ip_kv_cache:
+                indices = torch.tensor(cond_or_uncond, dtype=torch.int64, device=q.device)
+                # (2, B, T, C) -> (len(cond_or_uncond) * batch_prompt * B, T, C), v is scaled by weight here.
+                # inactive conditions are never used, so nothing is built for them.
+                self.ip_kv_cache[key] = [
+                    (
+                        ip_k.index_select(0, indices).repeat(1, batch_prompt, 1, 1).flatten(0, 1),
+                        ip_v.index_select(0, indices).repeat(1, batch_prompt, 1, 1).flatten(0, 1) * weight,
+                    ) if active else None
+                    for ip_k, ip_v, weight, active in zip(self.ip_ks, self.ip_vs, self.weights, self.actives)
+                ]
+
+            for ip_kv, mask, mask_cache, fuse, torch_compile in zip(self.ip_kv_cache[key], self.masks, self.mask_caches, self.fuses, self.torch_compiles):
+                if ip_kv is None:
+                    continue
+                ip_k, ip_v = ip_kv
+
+                # a different blend, not equal to the separate attention at any weight: ip tokens share one softmax
+                # with the text tokens, giving a*attn(q, k, v) + (1-a)*weight*attn(q, ip_k, ip_v) where a is the
+                # softmax mass of the text tokens. masks act on queries and can't be fused this way.
+                if fuse and mask is None:
+                    # fold multiple images into the token axis to match the batch of context_attn2,
+                    # and use its dtype so that torch.cat doesn't promote a fp16/bf16 mix to fp32
+                    k.append(ip_k.reshape(b, -1, ip_k.shape[-1]).to(context_attn2.dtype))
+                    v.append(ip_v.reshape(b, -1, ip_v.shape[-1]).to(value_attn2.dtype))
+                    continue
+
+                mask_downsample = None
                 if mask is not None:
-                    mask_size = mask.shape[0] * mask.shape[1]
-                    down_sample_rate = int((mask_size // 64 // out.shape[1]) ** (1/2))
-                    mask_downsample = torch.nn.functional.interpolate(mask.unsqueeze(0).unsqueeze(0), scale_factor= 1/8/down_sample_rate, mode="nearest").squeeze(0)
-                    mask_downsample = mask_downsample.view(1,-1, 1).repeat(out.shape[0], 1, out.shape[2])
-                    ip_out = ip_out * mask_downsample
-
-                out = out + ip_out * weight
+                    # resolution of each block is fixed during sampling, (1, L, 1) is broadcasted to ip_out
+                    if q.shape[1] not in mask_cache:
+                        # latent size of this block, with the aspect ratio of the mask
+                        h = round((q.shape[1] * mask.shape[0] / mask.shape[1]) ** (1/2))
+                        w = q.shape[1] // h
+                        mask_downsample = F.adaptive_avg_pool2d(mask.unsqueeze(0).unsqueeze(0), (h, w))
+                        mask_cache[q.shape[1]] = mask_downsample.view(1, -1, 1)
+                    mask_downsample = mask_cache[q.shape[1]]
+
+                ip_branches.append((ip_k, ip_v, mask_downsample, torch_compile))
+
+            if len(k) > 1:
+                out = attention(q, torch.cat(k, dim=1), torch.cat(v, dim=1), extra_options)
+            else:
+                out = attention(q, k[0], v[0], extra_options)
+
+            for ip_k, ip_v, mask_downsample, torch_compile in ip_branches:
+                patch_forward = get_patch_forward() if torch_compile else _patch_forward
+                out = patch_forward(out, q, ip_k, ip_v, mask_downsample, n_heads, dim_head)
 
         return out.to(dtype=org_dtype)
     